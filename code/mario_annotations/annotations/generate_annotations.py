@@ -1,13 +1,27 @@
 ### This script is used to generate annotated event_files for the mario dataset from the pkl sidecars.
 
 import argparse
+import multiprocessing
 import os
 import os.path as op
+import re
 import retro
 import pandas as pd
 import pickle
 import numpy as np
 import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back on the standard json parser
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, fall back on the NumPy event generators
+    njit = None
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -56,8 +70,62 @@ parser.add_argument(
     help="List of sessions to process (e.g., ses-001 ses-002). If not specified, all sessions are processed.",
 )
 
+parser.add_argument(
+    "-j",
+    "--n_jobs",
+    default=None,
+    type=int,
+    help="Number of runs to process in parallel. If not specified, uses all available CPUs.",
+)
+
+ACTIONS = ["UP", "DOWN", "LEFT", "RIGHT", "A", "B", "START", "SELECT"]
+# Enemy slots in which kills are detected, the last one also holds powerups
+KILL_SLOTS = [f"enemy_kill3{ii}" for ii in range(6)]
+
+_EVENT_COLUMNS = [
+    "onset",
+    "duration",
+    "trial_type",
+    "level",
+    "frame_start",
+    "frame_stop",
+]
+# Explicit dtypes of the generated events' timings, which match the onset and
+# duration columns of the repetition events they are concatenated with. The
+# labels and frame indices are left to pandas: the concatenation would turn
+# categoricals back into strings and, because the repetition rows have no
+# frame indices, fixed-width integers into floats anyway.
+_EVENT_DTYPES = {
+    "onset": "float64",
+    "duration": "float64",
+}
+
+# Clip .json files, e.g. sub-01_ses-001_task-mario_run-01_..._clip-00101030001234.json
+# The clip code is {ses:03}{run:02}{bk2_idx:02}{start_frame:07}
+_CLIP_FNAME_RE = re.compile(
+    r"^(?P<sub>sub-[^_]+)_(?P<ses>ses-[^_]+)_(?:.*_)?(?P<run>run-[^_]+)_.*"
+    r"-[^-]{5}(?P<bk2_idx>[^-]{2})[^-]*\.json$"
+)
+
+# Event types detected by _scan_game_events, indexed by their code
+_GAME_EVENT_TYPES = np.array(
+    [
+        "Kill/stomp",
+        "Kill/impact",
+        "Kill/kick",
+        "Hit/powerup_lost",
+        "Hit/life_lost",
+        "Brick_smashed",
+        "Coin_collected",
+        "Powerup_collected",
+    ],
+    dtype=object,
+)
+
 
-def create_runevents(runvars, run_id, events_dataframe, CLIPS_PATH=None, FS=60):
+def create_runevents(
+    runvars, run_id, events_dataframe, CLIPS_PATH=None, FS=60, clips_index=None
+):
     """Create a BIDS compatible events dataframe from game variables and start/duration info of repetitions
 
     Parameters
@@ -68,6 +136,9 @@ def create_runevents(runvars, run_id, events_dataframe, CLIPS_PATH=None, FS=60):
         A BIDS-formatted DataFrame specifying the onset and duration of each repetition.
     FS : int
         The sampling rate of the .bk2 file
+    clips_index : dict
+        Index of the clips .json files, as returned by index_clips. Built from
+        CLIPS_PATH if not provided.
     get_actions : boolean
         If True, generates actions events based on key presses
     get_healthloss : boolean
@@ -80,104 +151,174 @@ def create_runevents(runvars, run_id, events_dataframe, CLIPS_PATH=None, FS=60):
     events_df :
         An events DataFrame in BIDS-compatible format.
     """
-    all_df = [events_dataframe]
+    if CLIPS_PATH is not None and clips_index is None:
+        clips_index = index_clips(CLIPS_PATH)
+
+    events = {col: [] for col in _EVENT_COLUMNS}
     for idx, repvars in enumerate(runvars):
-        n_frames_total = len(repvars["START"])
-        repvars["rep_onset"] = [events_dataframe["onset"][idx]]
-        repvars["rep_duration"] = n_frames_total / FS
+        if repvars:  # Check if repetition logs are available
+            rep_onset = float(events_dataframe["onset"].iloc[idx])
 
-        if len(repvars.keys()) > 0:  # Check if repetition logs are available
+            rep_events = []
             # Actions
-            ACTIONS = ["UP", "DOWN", "LEFT", "RIGHT", "A", "B", "START", "SELECT"]
-            for act in ACTIONS:
-                temp_df = generate_key_events(repvars, act, FS=FS)
-                temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-                all_df.append(temp_df)
-
-            # Kills
-            temp_df = generate_kill_events(repvars, FS=FS)
-            temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-            all_df.append(temp_df)
-
-            # Hits taken
-            temp_df = generate_hits_taken_events(repvars, FS=FS)
-            temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-            all_df.append(temp_df)
-
-            # Bricks smashed
-            temp_df = generate_bricks_smashed_events(repvars, FS=FS)
-            temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-            all_df.append(temp_df)
-
-            # Coins collected
-            temp_df = generate_coin_events(repvars, FS=FS)
-            temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-            all_df.append(temp_df)
-
-            # Powerups
-            temp_df = generate_powerup_events(repvars, FS=FS)
-            temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-            all_df.append(temp_df)
+            rep_events.append(generate_action_events(repvars, FS=FS))
+
+            if njit is not None:
+                # Kills, hits taken, bricks smashed, coins and powerups
+                rep_events.append(generate_game_events(repvars, FS=FS))
+            else:
+                # Compute the variable increments once, they are shared by the generators
+                diff_score = np.diff(repvars["score"])
+                diff_lives = np.diff(repvars["lives"])
+                diff_powerstate = np.diff(repvars["powerstate"])
+                diff_coins = np.diff(repvars["coins"])
+
+                # Kills
+                rep_events.append(generate_kill_events(repvars, FS=FS))
+
+                # Hits taken
+                rep_events.append(
+                    generate_hits_taken_events(
+                        repvars,
+                        FS=FS,
+                        diff_powerstate=diff_powerstate,
+                        diff_lives=diff_lives,
+                    )
+                )
+
+                # Bricks smashed
+                rep_events.append(
+                    generate_bricks_smashed_events(
+                        repvars, FS=FS, diff_score=diff_score
+                    )
+                )
+
+                # Coins collected
+                rep_events.append(
+                    generate_coin_events(repvars, FS=FS, diff_coins=diff_coins)
+                )
+
+                # Powerups
+                rep_events.append(generate_powerup_events(repvars, FS=FS))
 
             # Scenes
             if CLIPS_PATH is not None:
-                temp_df = generate_scene_events(repvars, idx, run_id, CLIPS_PATH, FS=FS)
-                temp_df["onset"] = temp_df["onset"] + repvars["rep_onset"]
-                all_df.append(temp_df)
-
-    try:
-        events_df = pd.concat(all_df).sort_values(by="onset").reset_index(drop=True)
-    except ValueError:
+                rep_events.append(
+                    generate_scene_events(
+                        repvars,
+                        idx,
+                        run_id,
+                        CLIPS_PATH,
+                        FS=FS,
+                        clips_index=clips_index,
+                    )
+                )
+
+            for rep_event in rep_events:
+                # onsets are relative to the repetition, shift them to the run
+                rep_event["onset"] += rep_onset
+                for col in _EVENT_COLUMNS:
+                    events[col].append(rep_event[col])
+
+    # Build the annotations in one go instead of concatenating many small frames
+    annotations_df = pd.DataFrame(
+        {
+            col: np.concatenate(values) if len(values) > 0 else []
+            for col, values in events.items()
+        }
+    ).astype(_EVENT_DTYPES)
+    if events_dataframe.empty and annotations_df.empty:
         print("No bk2 files available for this run. Returning empty df.")
-        events_df = pd.DataFrame()
+        return annotations_df
+
+    events_df = pd.concat(
+        [events_dataframe, annotations_df], ignore_index=True, sort=False
+    )
+    # The events of each generator are already ordered by onset, which a
+    # stable mergesort takes advantage of
+    order = np.argsort(events_df["onset"].to_numpy(), kind="mergesort")
+    events_df = events_df.iloc[order].reset_index(drop=True)
+    # Only a handful of distinct labels, store them once instead of per row
+    events_df["trial_type"] = events_df["trial_type"].astype("category")
+    events_df["level"] = events_df["level"].astype("category")
     return events_df
 
 
-def generate_key_events(repvars, key, FS=60):
+def pack_actions(repvars):
+    """Pack the key press variables of a repetition into a single uint8 per
+    frame, bit i being set when the key ACTIONS[i] is pressed.
+
+    Parameters
+    ----------
+    repvars : list
+        A dict containing all the variables of a single repetition
+
+    Returns
+    -------
+    packed : numpy.ndarray
+        A uint8 array with one value per frame.
+    """
+    packed = np.zeros(len(repvars[ACTIONS[0]]), dtype=np.uint8)
+    for bit, key in enumerate(ACTIONS):
+        packed |= (np.asarray(repvars[key], dtype=np.uint8) & 1) << bit
+    return packed
+
+
+def generate_action_events(repvars, FS=60):
     """Create a BIDS compatible events dataframe containing key (actions) events
+    for all the keys in ACTIONS
+
+    The keys are packed one bit per key (see pack_actions), so that presses and
+    releases of all keys are detected with a single pass over the frames.
 
     Parameters
     ----------
     repvars : list
         A dict containing all the variables of a single repetition
-    key : string
-        Name of the action variable to process
     FS : int
         The sampling rate of the .bk2 file
 
     Returns
     -------
-    events_df :
-        An events DataFrame in BIDS-compatible format containing the
-        corresponding action events.
+    events : dict
+        The columns of a BIDS-compatible events file, as arrays, containing
+        the action events, ordered by key then by onset.
     """
+    packed = pack_actions(repvars)
+    # always keep the first and last value as 0 so every press has a release
+    packed[0] = 0
+    packed[-1] = 0
+
+    presses = packed[1:] & ~packed[:-1]
+    releases = packed[:-1] & ~packed[1:]
+    press_frames = np.flatnonzero(presses)
+    release_frames = np.flatnonzero(releases)
+    press_bits = presses[press_frames]
+    release_bits = releases[release_frames]
 
-    var = np.multiply(repvars[key], 1)
-    # always keep the first and last value as 0 so diff will register the state transition
-    var[0] = 0
-    var[-1] = 0
-
-    var_bin = [int(val) for val in var]
-    diffs = list(np.diff(var_bin, n=1))
-    presses = [round(i / FS, 3) for i, x in enumerate(diffs) if x == 1]
-    releases = [round(i / FS, 3) for i, x in enumerate(diffs) if x == -1]
-    frame_start = [i for i, x in enumerate(diffs) if x == 1]
-    frame_stop = [i for i, x in enumerate(diffs) if x == -1]
-    onset = presses
-    level = [repvars["level"] for x in onset]
-    duration = [round(releases[i] - presses[i], 3) for i in range(len(presses))]
-    trial_type = ["{}".format(key) for i in range(len(presses))]
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
-    )
-    return events_df
+    frame_start = []
+    frame_stop = []
+    trial_type = []
+    for bit, key in enumerate(ACTIONS):
+        key_mask = np.uint8(1 << bit)
+        key_starts = press_frames[(press_bits & key_mask) != 0]
+        frame_start.append(key_starts)
+        frame_stop.append(release_frames[(release_bits & key_mask) != 0])
+        trial_type.append(np.full(len(key_starts), key, dtype=object))
+    frame_start = np.concatenate(frame_start)
+    frame_stop = np.concatenate(frame_stop)
+
+    onset = np.round(frame_start / FS, 3)
+    duration = np.round((frame_stop - frame_start) / FS, 3)
+    level = np.full(len(onset), repvars["level"], dtype=object)
+    return {
+        "onset": onset,
+        "duration": duration,
+        "trial_type": np.concatenate(trial_type),
+        "level": level,
+        "frame_start": frame_start,
+        "frame_stop": frame_stop,
+    }
 
 
 def generate_kill_events(repvars, FS=60):
@@ -191,210 +332,239 @@ def generate_kill_events(repvars, FS=60):
 
     Returns
     -------
-    events_df :
-        An events DataFrame in BIDS-compatible format containing the
-        kill events.
+    events : dict
+        The columns of a BIDS-compatible events file, as arrays, containing
+        the kill events.
     """
-    onset = []
-    duration = []
-    trial_type = []
-    level = []
-    frame_start = []
-    frame_stop = []
-
     killvals_dict = {4: "stomp", 34: "impact", 132: "kick"}
 
-    n_frames_total = len(repvars["START"])
-    for frame_idx in range(n_frames_total - 1):
-        for ii in range(6):
-            curr_val = repvars[f"enemy_kill3{ii}"][frame_idx]
-            next_val = repvars[f"enemy_kill3{ii}"][frame_idx + 1]
-            if curr_val in [4, 34, 132] and curr_val != next_val:
-                killstring = f"Kill/{killvals_dict[curr_val]}"
-                if ii == 5:
-                    if repvars["powerup_yes_no"] == 0:
-                        onset.append(frame_idx / FS)
-                        duration.append(0)
-                        trial_type.append(killstring)
-                        level.append(repvars["level"])
-                        frame_start.append(frame_idx)
-                        frame_stop.append(frame_idx)
-                else:
-                    onset.append(frame_idx / FS)
-                    duration.append(0)
-                    trial_type.append(killstring)
-                    level.append(repvars["level"])
-                    frame_start.append(frame_idx)
-                    frame_stop.append(frame_idx)
-
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
+    slots = np.stack([np.asarray(repvars[key]) for key in KILL_SLOTS])
+    curr_val = slots[:, :-1]
+    next_val = slots[:, 1:]
+    is_kill = np.isin(curr_val, list(killvals_dict)) & (curr_val != next_val)
+    # the last enemy slot also holds powerups, only count it when none is on screen
+    is_kill[5] &= np.asarray(repvars["powerup_yes_no"])[:-1] == 0
+
+    # transpose so that events are ordered by frame, then by enemy slot
+    frame_start, slot_idx = np.nonzero(is_kill.T)
+    frame_stop = frame_start
+    onset = frame_start / FS
+    duration = np.zeros(len(onset))
+    trial_type = np.array(
+        [f"Kill/{killvals_dict[val]}" for val in curr_val[slot_idx, frame_start]],
+        dtype=object,
     )
-    return events_df
-
-
-def generate_hits_taken_events(repvars, FS=60):
-    onset = []
-    duration = []
-    trial_type = []
-    level = []
-    frame_start = []
-    frame_stop = []
+    level = np.full(len(onset), repvars["level"], dtype=object)
+
+    return {
+        "onset": onset,
+        "duration": duration,
+        "trial_type": trial_type,
+        "level": level,
+        "frame_start": frame_start,
+        "frame_stop": frame_stop,
+    }
+
+
+def _frame_events(frames, trial_type, level, FS=60):
+    """Create zero-duration events (as column arrays) at the given frame indices.
+    trial_type is either a single label or one label per frame."""
+    n_events = len(frames)
+    return {
+        "onset": frames / FS,
+        "duration": np.zeros(n_events),
+        "trial_type": np.full(n_events, trial_type, dtype=object),
+        "level": np.full(n_events, level, dtype=object),
+        "frame_start": frames,
+        "frame_stop": frames,
+    }
+
+
+def generate_hits_taken_events(repvars, FS=60, diff_powerstate=None, diff_lives=None):
+    if diff_powerstate is None:
+        diff_powerstate = np.diff(repvars["powerstate"])
+    if diff_lives is None:
+        diff_lives = np.diff(repvars["lives"])
 
     # Powerup lost
-    diff_state = list(np.diff(repvars["powerstate"]))
-    for idx_val, val in enumerate(diff_state):
-        if val < -10000:
-            onset.append(idx_val / FS)
-            duration.append(0)
-            trial_type.append("Hit/powerup_lost")
-            level.append(repvars["level"])
-            frame_start.append(idx_val)
-            frame_stop.append(idx_val)
-
+    powerup_lost = _frame_events(
+        np.flatnonzero(diff_powerstate < -10000),
+        "Hit/powerup_lost",
+        repvars["level"],
+        FS=FS,
+    )
     # Lives lost
-    diff_lives = list(np.diff(repvars["lives"]))
-    for idx_val, val in enumerate(diff_lives):
-        if val < 0:
-            onset.append(idx_val / FS)
-            duration.append(0)
-            trial_type.append("Hit/life_lost")
-            level.append(repvars["level"])
-            frame_start.append(idx_val)
-            frame_stop.append(idx_val)
-
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
+    life_lost = _frame_events(
+        np.flatnonzero(diff_lives < 0), "Hit/life_lost", repvars["level"], FS=FS
     )
-    return events_df
+    return {
+        col: np.concatenate([powerup_lost[col], life_lost[col]])
+        for col in _EVENT_COLUMNS
+    }
 
 
-def generate_bricks_smashed_events(repvars, FS=60):
+def generate_bricks_smashed_events(repvars, FS=60, diff_score=None):
+    if diff_score is None:
+        diff_score = np.diff(repvars["score"])
 
-    onset = []
-    duration = []
-    trial_type = []
-    level = []
-    frame_start = []
-    frame_stop = []
+    jump_airborne = np.asarray(repvars["jump_airborne"])[:-1]
+    frames = np.flatnonzero((diff_score == 5) & (jump_airborne == 1))
+    return _frame_events(frames, "Brick_smashed", repvars["level"], FS=FS)
 
-    score_increments = list(np.diff(repvars["score"]))
-    for idx_val, inc in enumerate(score_increments):
-        if inc == 5:
-            if repvars["jump_airborne"][idx_val] == 1:
-                onset.append(idx_val / FS)
-                duration.append(0)
-                trial_type.append("Brick_smashed")
-                level.append(repvars["level"])
-                frame_start.append(idx_val)
-                frame_stop.append(idx_val)
-
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
-    )
-    return events_df
 
+def generate_coin_events(repvars, FS=60, diff_coins=None):
+    if diff_coins is None:
+        diff_coins = np.diff(repvars["coins"])
 
-def generate_coin_events(repvars, FS=60):
-    onset = []
-    duration = []
-    trial_type = []
-    level = []
-    frame_start = []
-    frame_stop = []
-
-    diff_coins = np.diff(repvars["coins"])
-    for idx_val, val in enumerate(diff_coins):
-        if val > 0:
-            onset.append(idx_val / FS)
-            duration.append(0)
-            trial_type.append("Coin_collected")
-            level.append(repvars["level"])
-            frame_start.append(idx_val)
-            frame_stop.append(idx_val)
-
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
-    )
-    return events_df
+    frames = np.flatnonzero(diff_coins > 0)
+    return _frame_events(frames, "Coin_collected", repvars["level"], FS=FS)
 
 
 def generate_powerup_events(repvars, FS=60):
-    onset = []
-    duration = []
-    trial_type = []
-    level = []
-    frame_start = []
-    frame_stop = []
-
-    """ ### Currently broken
-    diff_powerup = np.diff(repvars['powerup_yes_no'])
+    ### Currently broken
+    # diff_powerup = np.diff(repvars['powerup_yes_no'])
     # powerup on screen events
-    for idx, val in enumerate(repvars['powerup_yes_no'][:-1]):
-        if val == 46:
-            idx_stop = idx
-            while diff_powerup[idx_stop] != -46:
-                idx_stop += 1
-            onset.append(idx/FS)
-            duration.append((idx_stop-idx)/FS)
-            trial_type.append('Powerup_on_screen')
-            level.append(repvars['level'])
-    """
+    # for idx, val in enumerate(repvars['powerup_yes_no'][:-1]):
+    #     if val == 46:
+    #         idx_stop = idx
+    #         while diff_powerup[idx_stop] != -46:
+    #             idx_stop += 1
+    #         onset.append(idx/FS)
+    #         duration.append((idx_stop-idx)/FS)
+    #         trial_type.append('Powerup_on_screen')
+    #         level.append(repvars['level'])
+
     # powerup collect events
-    for idx, val in enumerate(repvars["player_state"][:-1]):
-        if val in [9, 12, 13]:
-            if repvars["player_state"][idx + 1] != val:
-                onset.append(idx / FS)
-                duration.append(0)
-                trial_type.append("Powerup_collected")
-                level.append(repvars["level"])
-                frame_start.append(idx)
-                frame_stop.append(idx)
-
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
+    player_state = np.asarray(repvars["player_state"])
+    curr_val = player_state[:-1]
+    next_val = player_state[1:]
+    frames = np.flatnonzero(np.isin(curr_val, [9, 12, 13]) & (next_val != curr_val))
+    return _frame_events(frames, "Powerup_collected", repvars["level"], FS=FS)
+
+
+def _scan_game_events(
+    kills, powerup_yes_no, powerstate, lives, score, jump_airborne, coins, player_state
+):
+    """Detect the events of generate_kill_events, generate_hits_taken_events,
+    generate_bricks_smashed_events, generate_coin_events and
+    generate_powerup_events in a single pass over the frames.
+
+    Returns the frame index and the code (index in _GAME_EVENT_TYPES) of each
+    event, ordered by frame then in the order of the generators above.
+    """
+    n_steps = max(score.shape[0] - 1, 0)
+    # at most 6 kills, 2 hits, 1 brick, 1 coin and 1 powerup per frame
+    frames = np.empty(11 * n_steps, dtype=np.int64)
+    codes = np.empty(11 * n_steps, dtype=np.int8)
+    n_events = 0
+    for i in range(n_steps):
+        # Kills
+        for ii in range(6):
+            curr_val = kills[ii, i]
+            if curr_val == kills[ii, i + 1]:
+                continue
+            # the last enemy slot also holds powerups
+            if ii == 5 and powerup_yes_no[i] != 0:
+                continue
+            if curr_val == 4:
+                code = 0
+            elif curr_val == 34:
+                code = 1
+            elif curr_val == 132:
+                code = 2
+            else:
+                continue
+            frames[n_events] = i
+            codes[n_events] = code
+            n_events += 1
+        # Hits taken
+        if powerstate[i + 1] - powerstate[i] < -10000:
+            frames[n_events] = i
+            codes[n_events] = 3
+            n_events += 1
+        if lives[i + 1] - lives[i] < 0:
+            frames[n_events] = i
+            codes[n_events] = 4
+            n_events += 1
+        # Bricks smashed
+        if score[i + 1] - score[i] == 5 and jump_airborne[i] == 1:
+            frames[n_events] = i
+            codes[n_events] = 5
+            n_events += 1
+        # Coins collected
+        if coins[i + 1] - coins[i] > 0:
+            frames[n_events] = i
+            codes[n_events] = 6
+            n_events += 1
+        # Powerups
+        curr_val = player_state[i]
+        if (curr_val == 9 or curr_val == 12 or curr_val == 13) and player_state[
+            i + 1
+        ] != curr_val:
+            frames[n_events] = i
+            codes[n_events] = 7
+            n_events += 1
+    return frames[:n_events], codes[:n_events]
+
+
+if njit is not None:
+    _scan_game_events = njit(cache=True)(_scan_game_events)
+
+
+def generate_game_events(repvars, FS=60):
+    """Create the kill, hits taken, bricks smashed, coin and powerup events of a
+    repetition in a single pass over its frames. Gives the same events as the
+    corresponding generate_*_events functions, but is only fast when the scan
+    is compiled with numba.
+
+    Parameters
+    ----------
+    repvars : list
+        A dict containing all the variables of a single repetition.
+    FS : int
+        The sampling rate of the .bk2 file
+
+    Returns
+    -------
+    events : dict
+        The columns of a BIDS-compatible events file, as arrays, containing
+        the game events.
+    """
+    kills = np.stack([np.asarray(repvars[key]) for key in KILL_SLOTS])
+    frames, codes = _scan_game_events(
+        kills,
+        np.asarray(repvars["powerup_yes_no"]),
+        np.asarray(repvars["powerstate"]),
+        np.asarray(repvars["lives"]),
+        np.asarray(repvars["score"]),
+        np.asarray(repvars["jump_airborne"]),
+        np.asarray(repvars["coins"]),
+        np.asarray(repvars["player_state"]),
     )
-    return events_df
+    return _frame_events(frames, _GAME_EVENT_TYPES[codes], repvars["level"], FS=FS)
+
+
+def index_clips(CLIPS_PATH):
+    """
+    Walks CLIPS_PATH once and indexes the clips .json files by repetition.
 
+    The keys are (sub, ses, run, bk2_idx) tuples, e.g. ("sub-01", "ses-001",
+    "run-01", "03"), where bk2_idx is read from the clip code.
+    """
+    clips_index = defaultdict(list)
+    for root, folder, files in sorted(os.walk(CLIPS_PATH)):
+        for file in sorted(files):
+            match = _CLIP_FNAME_RE.match(file)
+            if match is not None:
+                clips_index[match.group("sub", "ses", "run", "bk2_idx")].append(
+                    op.join(root, file)
+                )
+    return clips_index
 
-def generate_scene_events(repvars, bk2_idx, run, CLIPS_PATH, FS=60):
+
+def generate_scene_events(repvars, bk2_idx, run, CLIPS_PATH, FS=60, clips_index=None):
     """
-    Generates an events_df of clips relative to the beginning of the repetition.
+    Generates the events of clips relative to the beginning of the repetition.
     """
 
     onset = []
@@ -408,45 +578,264 @@ def generate_scene_events(repvars, bk2_idx, run, CLIPS_PATH, FS=60):
     sub = fname.split("_")[0]
     ses = fname.split("_")[1]
 
+    if clips_index is None:
+        clips_index = index_clips(CLIPS_PATH)
+
     # Collect all jsons files corresponding to sub ses run in CLIPS_PATH
-    for root, folder, files in sorted(os.walk(CLIPS_PATH)):
-        if sub in root and ses in root:
-            for file in files:
-                file_bk2_idx = file.split("-")[-1][5:7]
-                if run in file:
-                    if file_bk2_idx == str(bk2_idx).zfill(2):
-                        if file.endswith(".json"):
-                            # Load json file
-                            json_path = op.join(root, file)
-                            with open(json_path, "r") as f:
-                                clip_metadata = json.load(f)
-                            clip_code = str(clip_metadata["ClipCode"])
-                            start_frame = clip_metadata["StartFrame"]
-                            end_frame = clip_metadata["EndFrame"]
-                            scene = clip_metadata["SceneFullName"]
-
-                            onset.append(start_frame / FS)
-                            duration.append((end_frame - start_frame) / FS)
-                            trial_type.append(f"scene-{scene}_code-{clip_code}")
-                            level.append(clip_metadata["LevelFullName"])
-                            frame_start.append(start_frame)
-                            frame_stop.append(end_frame)
-
-    events_df = pd.DataFrame(
-        data={
-            "onset": onset,
-            "duration": duration,
-            "trial_type": trial_type,
-            "level": level,
-            "frame_start": frame_start,
-            "frame_stop": frame_stop,
-        }
+    for json_path in clips_index.get((sub, ses, run, str(bk2_idx).zfill(2)), []):
+        # Load json file
+        with open(json_path, "r") as f:
+            clip_metadata = json.load(f)
+        clip_code = str(clip_metadata["ClipCode"])
+        start_frame = clip_metadata["StartFrame"]
+        end_frame = clip_metadata["EndFrame"]
+        scene = clip_metadata["SceneFullName"]
+
+        onset.append(start_frame / FS)
+        duration.append((end_frame - start_frame) / FS)
+        trial_type.append(f"scene-{scene}_code-{clip_code}")
+        level.append(clip_metadata["LevelFullName"])
+        frame_start.append(start_frame)
+        frame_stop.append(end_frame)
+
+    return {
+        "onset": np.array(onset, dtype=float),
+        "duration": np.array(duration, dtype=float),
+        "trial_type": np.array(trial_type, dtype=object),
+        "level": np.array(level, dtype=object),
+        "frame_start": np.array(frame_start, dtype=int),
+        "frame_stop": np.array(frame_stop, dtype=int),
+    }
+
+
+def compact_repvars(repvars):
+    """Convert the per-frame game variables of a repetition to compact ndarrays
+
+    Each numeric list is converted once to the smallest signed integer dtype
+    that holds both its values and the difference between any two of them, so
+    that the np.diff calls of the event generators cannot overflow. Boolean
+    variables (e.g. key presses) are stored as bool arrays. Nested and
+    non-numeric lists are left untouched.
+
+    Parameters
+    ----------
+    repvars : dict
+        A dict containing all the variables of a single repetition, as loaded
+        from the .json sidecar.
+
+    Returns
+    -------
+    repvars : dict
+        The same dict, with its numeric lists replaced by ndarrays.
+    """
+    for key, values in repvars.items():
+        if not isinstance(values, list) or len(values) == 0:
+            continue
+        try:
+            arr = np.asarray(values)
+        except ValueError:  # ragged nested lists
+            continue
+        if arr.ndim != 1 or arr.dtype.kind not in "bif":
+            continue  # leave non-numeric and nested variables untouched
+        if arr.dtype.kind == "i":
+            lo, hi = arr.min(), arr.max()
+            span = int(hi) - int(lo)
+            for dtype in (np.int8, np.int16, np.int32):
+                info = np.iinfo(dtype)
+                if info.min <= min(lo, -span) and max(hi, span) <= info.max:
+                    arr = arr.astype(dtype)
+                    break
+        repvars[key] = arr
+    return repvars
+
+
+def load_repvars(variables_sidecar_fname):
+    """Load the game variables of a repetition from its .json sidecar
+
+    The parsed variables are cached in a .npz file next to the sidecar, which
+    is loaded instead of the .json on later runs as long as it is not older
+    than the sidecar.
+
+    Parameters
+    ----------
+    variables_sidecar_fname : str or None
+        Path to the variables sidecar of a .bk2 file.
+
+    Returns
+    -------
+    repvars : dict or None
+        A dict containing all the variables of a single repetition, with
+        per-frame variables as ndarrays, or None if the sidecar is not
+        available.
+    """
+    if variables_sidecar_fname is None or not op.exists(variables_sidecar_fname):
+        return None
+
+    cache_fname = op.splitext(variables_sidecar_fname)[0] + ".npz"
+    if op.exists(cache_fname) and op.getmtime(cache_fname) >= op.getmtime(
+        variables_sidecar_fname
+    ):
+        with np.load(cache_fname) as cache:
+            repvars = {key: cache[key] for key in cache.files}
+        repvars.update(json.loads(str(repvars.pop("__metadata__"))))
+        return repvars
+
+    with open(variables_sidecar_fname, "rb") as f:
+        if orjson is not None:
+            repvars = orjson.loads(f.read())
+        else:
+            repvars = json.load(f)
+    repvars = compact_repvars(repvars)
+    save_repvars_cache(repvars, cache_fname)
+    return repvars
+
+
+def save_repvars_cache(repvars, cache_fname):
+    """Save the variables of a repetition to a .npz cache
+
+    The per-frame arrays are stored as is, the other values (level, filename,
+    ...) are stored together as a JSON string. Failing to write the cache
+    (e.g. read-only dataset) is not an error.
+    """
+    arrays = {k: v for k, v in repvars.items() if isinstance(v, np.ndarray)}
+    metadata = {k: v for k, v in repvars.items() if not isinstance(v, np.ndarray)}
+    tmp_fname = cache_fname + ".tmp"
+    try:
+        # write to a temporary file first so that an interrupted run never
+        # leaves a truncated cache behind
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, __metadata__=np.asarray(json.dumps(metadata)), **arrays)
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        print(f"Could not cache variables to {cache_fname} : {e}")
+        if op.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+def process_run(
+    run_events_file,
+    run_id,
+    events_annotated_fname,
+    REPLAYS_PATH,
+    CLIPS_PATH=None,
+    clips_index=None,
+    FS=60,
+):
+    """Generate and save the annotated events file of a single run
+
+    Parameters
+    ----------
+    run_events_file : str
+        Path to the events.tsv file of the run.
+    run_id : str
+        Run entity of the run (e.g. "run-01").
+    events_annotated_fname : str
+        Path of the annotated events file to write.
+    REPLAYS_PATH : str
+        Path to the replays dataset, containing the variables sidecars.
+    CLIPS_PATH : str
+        Path to the scenes dataset. If None, no scene events are generated.
+    clips_index : dict
+        Index of the clips .json files, as returned by index_clips. Built from
+        CLIPS_PATH if not provided.
+    FS : int
+        The sampling rate of the .bk2 files
+    """
+    print(f"Processing : {op.basename(run_events_file)}")
+    # Only parse the index and the columns used for the repetition events
+    rep_columns = ["trial_type", "onset", "level", "stim_file"]
+    index_column = pd.read_table(run_events_file, nrows=0).columns[0]
+    events_dataframe = pd.read_table(
+        run_events_file,
+        index_col=0,
+        usecols=[index_column] + rep_columns,
+        dtype={"trial_type": "category", "level": "category"},
     )
-    return events_df
+    events_dataframe = events_dataframe[
+        events_dataframe["trial_type"] == "gym-retro_game"
+    ]  # select only repetition events
+    events_dataframe = events_dataframe[
+        rep_columns
+    ].reset_index()  # select only relevant columns
+    bk2_files = events_dataframe["stim_file"].values.tolist()
+    sidecar_fnames = []
+    for bk2_file in bk2_files:
+        if bk2_file != "Missing file" and type(bk2_file) != float:
+            sub = bk2_file.split("/")[0]
+            ses = bk2_file.split("/")[1]
+            filename = bk2_file.split("/")[-1]
+            sidecar_fnames.append(
+                op.join(
+                    REPLAYS_PATH,
+                    sub,
+                    ses,
+                    "beh",
+                    "variables",
+                    filename.replace(".bk2", ".json"),
+                )
+            )
+        else:
+            sidecar_fnames.append(None)
+
+    # Read and parse the sidecars of the run concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        loaded_repvars = list(executor.map(load_repvars, sidecar_fnames))
+
+    # Repetition info, filled per repetition and assigned once per column
+    levels = events_dataframe["level"].to_numpy(dtype=object, copy=True)
+    n_frames = np.full(len(bk2_files), np.nan)
+
+    runvars = []
+    for bk2_idx, (bk2_file, repvars) in enumerate(zip(bk2_files, loaded_repvars)):
+        if bk2_file != "Missing file" and type(bk2_file) != float:
+            print("Adding : " + bk2_file)
+            if repvars is not None:
+                # replace level value in the dataframe by the one in the repvars dict
+                levels[bk2_idx] = repvars["level"]
+                n_frames[bk2_idx] = len(repvars["score"])
+                runvars.append(repvars)
+            else:
+                # keep runvars aligned with the repetitions and their onsets
+                print("No variables sidecar found, skipping")
+                runvars.append({})
+        else:
+            print("Missing file, skipping")
+            runvars.append({})
+
+    # Add info to repetition events
+    events_dataframe["level"] = levels
+    events_dataframe["frame_start"] = np.where(np.isnan(n_frames), np.nan, 0)
+    events_dataframe["frame_stop"] = n_frames
+    events_dataframe["duration"] = n_frames / FS
+    # rename index column to rep_index
+    events_dataframe = events_dataframe.rename(columns={"index": "rep_index"})
+
+    # Add phase (discovery VS practice)
+    if events_dataframe["level"].values[0] == events_dataframe["level"].values[1]:
+        phase = "discovery"
+    else:
+        phase = "practice"
+    events_dataframe["phase"] = phase
+    events_df = create_runevents(
+        runvars,
+        run_id,
+        events_dataframe,
+        CLIPS_PATH,
+        FS=FS,
+        clips_index=clips_index,
+    )
+
+    events_df.to_csv(events_annotated_fname, sep="\t", index=False)
+
+
+def _process_run_job(job):
+    return process_run(*job)
 
 
 def main(args):
     FS = 60
+    if args.n_jobs is not None and args.n_jobs < 1:
+        parser.error("--n_jobs must be at least 1")
 
     # Get datapath
     DATA_PATH = args.datapath
@@ -458,6 +847,11 @@ def main(args):
     retro.data.Integrations.add_custom_path(stimuli_path)
 
     CLIPS_PATH = args.clips_path
+    # Walk the clips folder once, instead of once per repetition
+    clips_by_run = defaultdict(dict)
+    if CLIPS_PATH is not None:
+        for clip_key, json_paths in index_clips(CLIPS_PATH).items():
+            clips_by_run[clip_key[:3]][clip_key] = json_paths
 
     REPLAYS_PATH = args.replays_path
 
@@ -472,7 +866,8 @@ def main(args):
     if sessions:
         print(f"Filtering sessions: {', '.join(sessions)}")
 
-    # Walk through all folders looking for .bk2 files
+    # Walk through all folders looking for events.tsv files, each run is processed independently
+    jobs = []
     for root, folder, files in sorted(os.walk(DATA_PATH)):
         if not "sourcedata" in root:
             # Check if this path matches subject filter
@@ -488,10 +883,10 @@ def main(args):
             for file in files:
                 if "events.tsv" in file and not "annotated" in file:
                     run_events_file = op.join(root, file)
+                    sub = file.split("_")[0]
+                    ses = file.split("_")[1]
                     run_id = file.split("_")[3]
                     if OUTPUT_PATH is not None:
-                        sub = file.split("_")[0]
-                        ses = file.split("_")[1]
                         events_annotated_fname = op.join(
                             OUTPUT_PATH,
                             sub,
@@ -505,80 +900,31 @@ def main(args):
                             "_events.", "_desc-annotated_events."
                         )
                     if not op.isfile(events_annotated_fname):
-                        print(f"Processing : {file}")
-                        events_dataframe = pd.read_table(run_events_file, index_col=0)
-                        events_dataframe = events_dataframe[
-                            events_dataframe["trial_type"] == "gym-retro_game"
-                        ]  # select only repetition events
-                        events_dataframe = events_dataframe[
-                            ["trial_type", "onset", "level", "stim_file"]
-                        ].reset_index()  # select only relevant columns
-                        bk2_files = events_dataframe["stim_file"].values.tolist()
-                        runvars = []
-                        for bk2_idx, bk2_file in enumerate(bk2_files):
-                            if bk2_file != "Missing file" and type(bk2_file) != float:
-                                print("Adding : " + bk2_file)
-                                sub = bk2_file.split("/")[0]
-                                ses = bk2_file.split("/")[1]
-                                filename = bk2_file.split("/")[-1]
-                                variables_sidecar_fname = op.join(
-                                    REPLAYS_PATH,
-                                    sub,
-                                    ses,
-                                    "beh",
-                                    "variables",
-                                    filename.replace(".bk2", ".json"),
-                                )
-                                if op.exists(variables_sidecar_fname):
-                                    with open(variables_sidecar_fname, "rb") as f:
-                                        repvars = json.load(f)
-
-                                    # Add info to repetition event
-                                    events_dataframe.loc[
-                                        events_dataframe["stim_file"] == bk2_file,
-                                        "level",
-                                    ] = repvars[
-                                        "level"
-                                    ]  # replace level value in the dataframe by the one in the repvars dict
-                                    events_dataframe.loc[
-                                        events_dataframe["stim_file"] == bk2_file,
-                                        "frame_start",
-                                    ] = int(0)
-                                    events_dataframe.loc[
-                                        events_dataframe["stim_file"] == bk2_file,
-                                        "frame_stop",
-                                    ] = int(len(repvars["score"]))
-                                    events_dataframe.loc[
-                                        events_dataframe["stim_file"] == bk2_file,
-                                        "duration",
-                                    ] = (
-                                        int(len(repvars["score"])) / FS
-                                    )
-
-                                    # rename index column to rep_index
-                                    events_dataframe.rename(
-                                        columns={"index": "rep_index"}, inplace=True
-                                    )
-
-                                    runvars.append(repvars)
-                            else:
-                                print("Missing file, skipping")
-                                runvars.append({})
-
-                        # Add phase (discovery VS practice)
-                        if (
-                            events_dataframe["level"].values[0]
-                            == events_dataframe["level"].values[1]
-                        ):
-                            phase = "discovery"
-                        else:
-                            phase = "practice"
-                        events_dataframe["phase"] = phase
-                        events_df = create_runevents(
-                            runvars, run_id, events_dataframe, CLIPS_PATH, FS=FS
+                        jobs.append(
+                            (
+                                run_events_file,
+                                run_id,
+                                events_annotated_fname,
+                                REPLAYS_PATH,
+                                CLIPS_PATH,
+                                clips_by_run.get((sub, ses, run_id), {}),
+                                FS,
+                            )
                         )
 
-                        events_df.to_csv(events_annotated_fname, sep="\t", index=False)
+    n_jobs = args.n_jobs if args.n_jobs is not None else os.cpu_count()
+    if n_jobs == 1 or len(jobs) <= 1:
+        for job in jobs:
+            _process_run_job(job)
+    else:
+        with multiprocessing.Pool(
+            min(n_jobs, len(jobs)),
+            initializer=retro.data.Integrations.add_custom_path,
+            initargs=(stimuli_path,),
+            maxtasksperchild=4,
+        ) as pool:
+            for _ in pool.imap_unordered(_process_run_job, jobs):
+                pass
 
 
 if __name__ == "__main__":
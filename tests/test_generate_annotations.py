@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("retro")
+
+from mario_annotations.annotations import generate_annotations as ga
+
+_NUMPY_GENERATORS = [
+    ga.generate_kill_events,
+    ga.generate_hits_taken_events,
+    ga.generate_bricks_smashed_events,
+    ga.generate_coin_events,
+    ga.generate_powerup_events,
+]
+
+
+def make_repvars(n_frames=5000, seed=0):
+    """Random game variables that trigger every kind of game event."""
+    rng = np.random.default_rng(seed)
+    repvars = {
+        key: rng.choice([0, 4, 34, 132, 7], n_frames).tolist() for key in ga.KILL_SLOTS
+    }
+    repvars["powerup_yes_no"] = rng.choice([0, 46], n_frames).tolist()
+    repvars["powerstate"] = rng.choice([0, 20000, 40000], n_frames).tolist()
+    repvars["lives"] = rng.integers(0, 4, n_frames).tolist()
+    repvars["score"] = np.cumsum(rng.choice([0, 0, 5, 100], n_frames)).tolist()
+    repvars["jump_airborne"] = rng.integers(0, 2, n_frames).tolist()
+    repvars["coins"] = rng.integers(0, 3, n_frames).tolist()
+    repvars["player_state"] = rng.choice([8, 9, 12, 13], n_frames).tolist()
+    repvars["level"] = "w1l1"
+    return ga.compact_repvars(repvars)
+
+
+def scan_implementations():
+    yield ga._scan_game_events
+    # the plain Python scan behind the numba kernel
+    if hasattr(ga._scan_game_events, "py_func"):
+        yield ga._scan_game_events.py_func
+
+
+@pytest.mark.parametrize("scan", list(scan_implementations()))
+@pytest.mark.parametrize("seed", [0, 1])
+def test_game_events_match_numpy_generators(monkeypatch, scan, seed):
+    repvars = make_repvars(seed=seed)
+    monkeypatch.setattr(ga, "_scan_game_events", scan)
+    fused = ga.generate_game_events(repvars)
+
+    separate = [generator(repvars) for generator in _NUMPY_GENERATORS]
+    expected = {
+        col: np.concatenate([events[col] for events in separate])
+        for col in ga._EVENT_COLUMNS
+    }
+    # the fused scan orders events by frame, then by generator
+    order = np.argsort(expected["frame_start"], kind="mergesort")
+
+    assert len(set(expected["trial_type"])) == len(ga._GAME_EVENT_TYPES)
+    for col in ga._EVENT_COLUMNS:
+        np.testing.assert_array_equal(fused[col], expected[col][order])